@@ -1,9 +1,11 @@
 
 from mgr_module import MgrModule, CommandResult
+from multiprocessing.pool import ThreadPool
 import threading
 import random
-import json
+import pickle
 import errno
+import traceback
 
 
 class Module(MgrModule):
@@ -23,7 +25,11 @@ class Module(MgrModule):
     WORKLOAD_THROW_EXCEPTION = "throw_exception"
     SHUTDOWN = "shutdown"
 
-    WORKLOADS = (WORKLOAD_COMMAND_SPAM, WORKLOAD_THROW_EXCEPTION)
+    WORKLOADS = frozenset({WORKLOAD_COMMAND_SPAM, WORKLOAD_THROW_EXCEPTION})
+
+    # The command_spam workload only varies the id and weight, so format
+    # its JSON directly (%r of a float gives the same text json.dumps does)
+    _REWEIGHT_TMPL = '{"prefix": "osd reweight", "id": %d, "weight": %r}'
 
     # The test code in qa/ relies on these options existing -- they
     # are of course not really used for anything in the module
@@ -42,7 +48,7 @@ class Module(MgrModule):
             {
                 "cmd": "mgr self-test background start name=workload,type=CephString",
                 "desc": "Activate a background workload (one of {0})".format(
-                    ", ".join(WORKLOADS)),
+                    ", ".join(sorted(WORKLOADS))),
                 "perm": "rw"
             },
             {
@@ -69,51 +75,89 @@ class Module(MgrModule):
 
     def __init__(self, *args, **kwargs):
         super(Module, self).__init__(*args, **kwargs)
-        self._event = threading.Event()
+        # Guards _workload; notified whenever it changes
+        self._cond = threading.Condition()
         self._workload = None
+        self._rng = random.Random()
+
+        self._dispatch = {
+            'mgr self-test run': self._cmd_run,
+            'mgr self-test background start': self._cmd_background_start,
+            'mgr self-test background stop': self._cmd_background_stop,
+            'mgr self-test config get': self._cmd_config_get,
+            'mgr self-test config get_localized':
+                self._cmd_config_get_localized,
+            'mgr self-test remote': self._cmd_remote,
+        }
+
+        # {data_name: value} for _cached_get, only filled in while
+        # _self_test() is running
+        self._get_cache = {}
+        self._get_cache_lock = threading.Lock()
 
     def handle_command(self, inbuf, command):
-        if command['prefix'] == 'mgr self-test run':
-            self._self_test()
-            return 0, '', 'Self-test succeeded'
-
-        elif command['prefix'] == 'mgr self-test background start':
-            if command['workload'] not in self.WORKLOADS:
-                return (-errno.EINVAL, '',
-                        "Workload not found '{0}'".format(command['workload']))
-            self._workload = command['workload']
-            self._event.set()
-            return 0, '', 'Running `{0}` in background'.format(self._workload)
-
-        elif command['prefix'] == 'mgr self-test background stop':
-            if self._workload:
-                was_running = self._workload
-                self._workload = None
-                self._event.set()
-                return 0, '', 'Stopping background workload `{0}`'.format(
-                        was_running)
-            else:
-                return 0, '', 'No background workload was running'
-        elif command['prefix'] == 'mgr self-test config get':
-            return 0, str(self.get_config(command['key'])), ''
-        elif command['prefix'] == 'mgr self-test config get_localized':
-            return 0, str(self.get_localized_config(command['key'])), ''
-        elif command['prefix'] == 'mgr self-test remote':
-            self._test_remote_calls()
-            return 0, '', 'Successfully called'
-        else:
+        handler = self._dispatch.get(command['prefix'])
+        if handler is None:
             return (-errno.EINVAL, '',
                     "Command not found '{0}'".format(command['prefix']))
+        return handler(inbuf, command)
+
+    def _cmd_run(self, inbuf, command):
+        self._self_test()
+        return 0, '', 'Self-test succeeded'
+
+    def _cmd_background_start(self, inbuf, command):
+        if command['workload'] not in self.WORKLOADS:
+            return (-errno.EINVAL, '',
+                    "Workload not found '{0}'".format(command['workload']))
+        with self._cond:
+            self._workload = command['workload']
+            self._cond.notify()
+        return 0, '', 'Running `{0}` in background'.format(
+                command['workload'])
+
+    def _cmd_background_stop(self, inbuf, command):
+        with self._cond:
+            was_running = self._workload
+            self._workload = None
+            self._cond.notify()
+        if was_running:
+            return 0, '', 'Stopping background workload `{0}`'.format(
+                    was_running)
+        else:
+            return 0, '', 'No background workload was running'
+
+    def _cmd_config_get(self, inbuf, command):
+        return 0, str(self.get_config(command['key'])), ''
+
+    def _cmd_config_get_localized(self, inbuf, command):
+        return 0, str(self.get_localized_config(command['key'])), ''
+
+    def _cmd_remote(self, inbuf, command):
+        self._test_remote_calls()
+        return 0, '', 'Successfully called'
 
     def _self_test(self):
         self.log.info("Running self-test procedure...")
 
-        self._self_test_osdmap()
-        self._self_test_getters()
-        self._self_test_config()
-        self._self_test_store()
-        self._self_test_misc()
-        self._self_test_perf_counters()
+        try:
+            # The read-only tests can overlap; the rest modify module
+            # state and run one at a time afterwards.
+            self._parallel_map(lambda test: test(), [
+                self._self_test_osdmap,
+                self._self_test_getters,
+                self._self_test_perf_counters,
+            ], 3)
+            self._self_test_config()
+            self._self_test_store()
+            self._self_test_misc()
+        finally:
+            # Don't hold on to the maps, and make the next run
+            # call get() again
+            with self._get_cache_lock:
+                self._get_cache.clear()
+
+        self.log.info("Finished self-test procedure.")
 
     def _self_test_getters(self):
         self.version
@@ -141,21 +185,63 @@ class Module(MgrModule):
                 "mon_status",
                 "mgr_map"
                 ]
-        for obj in objects:
-            self.get(obj)
+        self._parallel_map(lambda obj: self._cached_get(obj, copy=False),
+                           objects, 8)
 
         servers = self.list_servers()
         for server in servers:
             self.get_server(server['hostname'])
 
-        osdmap = self.get('osd_map')
-        for o in osdmap['osds']:
-            osd_id = o['osd']
-            self.get_metadata("osd", str(osd_id))
+        osdmap = self._cached_get('osd_map', copy=False)
+        osd_ids = [str(o['osd']) for o in osdmap['osds']]
+        self._parallel_map(lambda osd_id: self.get_metadata("osd", osd_id),
+                           osd_ids, 16)
 
         self.get_daemon_status("osd", "0")
         #send_command
 
+    def _parallel_map(self, fn, items, max_workers):
+        """
+        map() fn over items from a pool of threads, for fanning out
+        calls that spend their time in C++ without holding the GIL.
+        """
+        def call(item):
+            try:
+                return fn(item)
+            except Exception:
+                # The pool re-raises this in the caller, but on python2
+                # without the worker's traceback, so log it here.
+                self.log.error("Failed on {0!r}:\n{1}".format(
+                    item, traceback.format_exc()))
+                raise
+
+        pool = ThreadPool(max(1, min(max_workers, len(items))))
+        try:
+            return pool.map(call, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _cached_get(self, data_name, copy=True):
+        """
+        Like self.get(), but reuse a result already fetched during the
+        current _self_test() run.  Unless ``copy`` is False, callers get
+        their own copy, so they are free to mutate it.
+        """
+        with self._get_cache_lock:
+            value = self._get_cache.get(data_name)
+
+        # Fetch outside the lock so that callers on other threads can
+        # fetch different objects at the same time.
+        if value is None:
+            value = self.get(data_name)
+            with self._get_cache_lock:
+                self._get_cache[data_name] = value
+
+        if not copy:
+            return value
+        return pickle.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
     def _self_test_config(self):
         # This is not a strong test (can't tell if values really
         # persisted), it's just for the python interface bit.
@@ -174,8 +260,8 @@ class Module(MgrModule):
         self.set_store_json("testjsonkey", {"testblob": 2})
         assert self.get_store_json("testjsonkey") == {"testblob": 2}
 
-        assert sorted(self.get_store_prefix("test").keys()) == sorted(
-                list({"testkey", "testjsonkey"} | existing_keys))
+        expected = existing_keys | {"testkey", "testjsonkey"}
+        assert set(self.get_store_prefix("test").keys()) == expected
 
 
     def _self_test_perf_counters(self):
@@ -213,8 +299,6 @@ class Module(MgrModule):
         #inc.set_osd_reweights
         #inc.set_crush_compat_weight_set_weights
 
-        self.log.info("Finished self-test procedure.")
-
     def _test_remote_calls(self):
         # Test making valid call
         self.remote("influx", "handle_command", "", {"prefix": "influx self-test"})
@@ -223,13 +307,19 @@ class Module(MgrModule):
         mgr_map = self.get("mgr_map")
         all_modules = [m['name'] for m in mgr_map['available_modules']]
         disabled_modules = set(all_modules) - set(mgr_map['modules'])
-        disabled_module = list(disabled_modules)[0]
-        try:
-            self.remote(disabled_module, "handle_command", {"prefix": "influx self-test"})
-        except ImportError:
-            pass
+        if not disabled_modules:
+            self.log.warn("No disabled modules, skipping disabled module "
+                          "remote call test")
         else:
-            raise RuntimeError("ImportError not raised for disabled module")
+            disabled_module = next(iter(disabled_modules))
+            try:
+                self.remote(disabled_module, "handle_command",
+                            {"prefix": "influx self-test"})
+            except ImportError:
+                pass
+            else:
+                raise RuntimeError(
+                        "ImportError not raised for disabled module")
 
         # Test calling module that doesn't exist
         try:
@@ -249,41 +339,60 @@ class Module(MgrModule):
 
 
     def shutdown(self):
-        self._workload = self.SHUTDOWN
-        self._event.set()
+        with self._cond:
+            self._workload = self.SHUTDOWN
+            self._cond.notify()
 
     def _command_spam(self):
-        self.log.info("Starting command_spam workload...")
-        while not self._event.is_set():
-            osdmap = self.get_osdmap()
-            dump = osdmap.dump()
-            count = len(dump['osds'])
-            i = int(random.random() * count)
-            w = random.random()
-
-            result = CommandResult('')
-            self.send_command(result, 'mon', '', json.dumps({
-                'prefix': 'osd reweight',
-                'id': i,
-                'weight': w
-                }), '')
-
-            crush = osdmap.get_crush().dump()
+        # This loop doubles as a benchmark of mgr overhead, so keep
+        # attribute lookups out of it.  Note that configure_logger()
+        # leaves the python logger at DEBUG, so isEnabledFor() can't
+        # filter anything: keep per-iteration logging out of here too.
+        log = self.log
+        log.info("Starting command_spam workload...")
+
+        spam = self.WORKLOAD_COMMAND_SPAM
+        get_osdmap = self.get_osdmap
+        send_command = self.send_command
+        command_result = CommandResult
+        randrange = self._rng.randrange
+        rand = self._rng.random
+        tmpl = self._REWEIGHT_TMPL
+
+        # The map only changes on epoch bumps, so only dump it (and
+        # its CRUSH map) when we see a new epoch.
+        last_epoch = None
+        count = 0
+        while self._workload == spam:
+            osdmap = get_osdmap()
+            epoch = osdmap.get_epoch()
+            if epoch != last_epoch:
+                last_epoch = epoch
+                count = len(osdmap.dump()['osds'])
+                osdmap.get_crush().dump()
+            # An OSD-less map still sends a command for id 0
+            i = randrange(count) if count else 0
+            w = rand()
+
+            result = command_result('')
+            send_command(result, 'mon', '', tmpl % (i, w), '')
+
             r, outb, outs = result.wait()
 
-        self._event.clear()
-        self.log.info("Ended command_spam workload...")
+        log.info("Ended command_spam workload...")
 
     def serve(self):
         while True:
-            if self._workload == self.WORKLOAD_COMMAND_SPAM:
+            with self._cond:
+                while self._workload is None:
+                    self.log.info("Waiting for workload request...")
+                    self._cond.wait()
+                workload = self._workload
+
+            if workload == self.WORKLOAD_COMMAND_SPAM:
                 self._command_spam()
-            elif self._workload == self.SHUTDOWN:
+            elif workload == self.SHUTDOWN:
                 self.log.info("Shutting down...")
                 break
-            elif self._workload == self.WORKLOAD_THROW_EXCEPTION:
+            elif workload == self.WORKLOAD_THROW_EXCEPTION:
                 raise RuntimeError("Synthetic exception in serve")
-            else:
-                self.log.info("Waiting for workload request...")
-                self._event.wait()
-                self._event.clear()